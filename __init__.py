@@ -1,2 +1,2 @@
-from .decrypt import data_xor
-from .kakao_process import KakaoProcessor
\ No newline at end of file
+from .decrypt import data_xor, data_xor_stream
+from .kakao_process import KakaoProcessor, process_task
\ No newline at end of file
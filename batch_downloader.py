@@ -1,29 +1,38 @@
-import subprocess
-import sys
 import time
+import traceback
+import urllib.parse
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+from kakao_dl import download_pack, make_arg_parser
 
 BATCH_FILE_PATH = 'batch.txt'
 
 
+def _download(args, link):
+    print(f'Downloading: {link}')
+    try:
+        download_pack(link, args, concurrent_packs=args.batch_workers)
+    except (Exception, SystemExit):
+        print(f'!!!Error downloading {link}')
+        traceback.print_exc()
+
+
 def main():
-    all_links = []
+    args = make_arg_parser(batch=True).parse_args()
+    # progress bars and prompts of parallel downloads would interleave
+    args.quiet = True
+
+    # strip query string and drop duplicates, so repeated links are only downloaded once
     with open(BATCH_FILE_PATH) as f:
-        for line in f:
-            if line:
-                all_links.append(line.strip())
+        all_links = dict.fromkeys(line.strip().split('?')[0] for line in f if line.strip())
+    # group by host so requests can reuse the pooled connections
+    all_links = sorted(all_links, key=lambda link: urllib.parse.urlsplit(link).netloc)
     start_time = time.time()
-    for link in all_links:
-        print(f'Downloading: {link}')
-        # strip query string
-        link = link.split('?')[0]
-        proc = subprocess.Popen(
-                ['python', 'kakao_dl.py', link, '-q'] + sys.argv[1:],
-                stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
-        stdout, stderr = proc.communicate()
-        if proc.returncode != 0:
-            print(f'!!!Error downloading {link}, press enter to continue...')
-            print(stdout.decode('utf-8', errors='ignore'))
-            print(stderr.decode('utf-8', errors='ignore'))
+    # downloads are I/O bound, threads are enough. Processes are kept for isolation
+    executor_cls = ProcessPoolExecutor if args.processes else ThreadPoolExecutor
+    with executor_cls(max_workers=args.batch_workers) as executor:
+        list(executor.map(partial(_download, args), all_links))
     print(f'Finished in {int(time.time() - start_time)} seconds')
 
 
@@ -1,3 +1,7 @@
+import shutil
+from functools import lru_cache
+
+
 def generate_lfsr(key):
     d = list(key * 2)
     seq = [0, 0, 0]
@@ -49,9 +53,21 @@ def byte_xor(b, seq):
     return (result ^ b)
 
 
+@lru_cache()
+def generate_keystream(key, length=128):
+    # the lfsr doesn't depend on the data, so the keystream is the same for every file
+    s = generate_lfsr(key)
+    return bytes(byte_xor(0, s) for _ in range(length))
+
+
 def data_xor(data):
-    dat = list(data)
-    s = generate_lfsr('a271730728cbe141e47fd9d677e9006d')
-    for i in range(0, 128):
-        dat[i] = byte_xor(dat[i], s)
-    return bytes(dat)
+    keystream = generate_keystream('a271730728cbe141e47fd9d677e9006d')
+    n = min(len(keystream), len(data))
+    head = int.from_bytes(data[:n], 'big') ^ int.from_bytes(keystream[:n], 'big')
+    return head.to_bytes(n, 'big') + bytes(data[n:])
+
+
+def data_xor_stream(src, out, chunk=65536):
+    # only the first 128 bytes are encrypted, the rest can be copied as-is
+    out.write(data_xor(src.read(128)))
+    shutil.copyfileobj(src, out, chunk)
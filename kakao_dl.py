@@ -6,15 +6,16 @@ import re
 import shutil
 import sys
 import tempfile
-import time
 import zipfile
-from queue import Queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from urllib3.util.retry import Retry
 
-from decrypt import data_xor
-from kakao_process import KakaoProcessor, Operation, OutputFormat, ProcessTask, get_counter_value
+from decrypt import data_xor_stream
+from kakao_process import Operation, OutputFormat, ProcessTask, process_task
 
 _HEADER_KAKAO = {
     'User-Agent': 'Mozilla/5.0 (Linux; Android 12; SM-A226L Build/SP1A.210812.016; wv) AppleWebKit/537.36 (KHTML, like Gecko) Version/4.0 Chrome/108.0.5359.128 Mobile Safari/537.36;KAKAOTALK 2410030'}
@@ -23,12 +24,21 @@ _HEADER_CHROME_DEFAULT = {
     'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/114.0.0.0 Safari/537.36'}
 METADATA_URL_TEMPLATE = 'https://e.kakao.com/api/v1/items/t/{text_id}'
 SHARE_LINK_TEMPLATE = 'https://emoticon.kakao.com/items/{share_link_id}'
+ARCHIVE_URL_TEMPLATE = 'https://item.kakaocdn.net/dw/{num_pack_id}.file_pack.zip'
+_TIMEOUT = (5, 30)
 _proxies = None
 err_print = print
-norm_print = print
+
+# all requests go to a few kakao hosts, reuse connections instead of handshaking every time
+_SESSION = requests.Session()
+_SESSION.headers.update(_HEADER_KAKAO)
+_SESSION.mount('https://', HTTPAdapter(pool_connections=16, pool_maxsize=32,
+                                       max_retries=Retry(total=3, backoff_factor=0.3,
+                                                         status_forcelist=[502, 503, 504])))
 
 
 def set_proxy(proxies):
+    # passed on every request, session level proxies would lose to the environment ones
     global _proxies
     _proxies = proxies
 
@@ -37,7 +47,7 @@ def set_proxy(proxies):
 
 
 def get_num_pack_id_and_title(url):
-    text_content = requests.get(url, headers=_HEADER_KAKAO, proxies=_proxies).text
+    text_content = _SESSION.get(url, timeout=_TIMEOUT, proxies=_proxies).text
     id_ptn = re.compile(r'kakaotalk://store/emoticon/(\d+)')
     title_ptn = re.compile(r'<title>(.+)</title>')
     num_pack_id = id_ptn.search(text_content).group(1)
@@ -47,30 +57,157 @@ def get_num_pack_id_and_title(url):
 
 
 def get_sticker_text_id(url):
-    resp = requests.get(url, headers=_HEADER_CHROME_DEFAULT, proxies=_proxies)
+    # only the redirect target is needed, no need to download the page
+    resp = _SESSION.head(url, headers=_HEADER_CHROME_DEFAULT, allow_redirects=True, timeout=_TIMEOUT, proxies=_proxies)
     # remove query string
     text_id = resp.url.split('/')[-1].split('?')[0]
     return text_id
 
 
-def get_metadata(text_id):
-    resp = requests.get(METADATA_URL_TEMPLATE.format(text_id=text_id), headers=_HEADER_KAKAO, proxies=_proxies)
-    return resp.json()['result']
+def get_metadata(text_id, etag=None):
+    # metadata is None if it hasn't changed since etag
+    headers = {'If-None-Match': etag} if etag else None
+    resp = _SESSION.get(METADATA_URL_TEMPLATE.format(text_id=text_id), headers=headers, timeout=_TIMEOUT,
+                        proxies=_proxies)
+    if resp.status_code == 304:
+        return None, etag
+    return resp.json()['result'], resp.headers.get('ETag')
+
+
+def get_num_pack_id_from_metadata(metadata):
+    for key in ['itemId', 'packageId']:
+        if str(metadata.get(key, '')).isdigit():
+            return str(metadata[key])
+    return None
+
+
+def fetch_pack_info(id_url, share_link_id, cache_dir, refresh=False):
+    # pack metadata hardly ever changes, cache it so reruns can skip the requests
+    cache_path = os.path.join(cache_dir, f'{share_link_id}.json')
+    metadata = None
+    if os.path.exists(cache_path):
+        with open(cache_path, 'r', encoding='utf-8') as f:
+            cached = json.load(f)
+        if not refresh:
+            return cached['pack_info']
+        if cached['etag']:
+            # revalidate, a changed pack comes back in full and is used directly
+            text_id = cached['pack_info']['text_id']
+            metadata, etag = get_metadata(text_id, cached['etag'])
+            if metadata is None:
+                return cached['pack_info']
+
+    if metadata is None:
+        text_id = get_sticker_text_id(id_url)
+        metadata, etag = get_metadata(text_id)
+    num_pack_id = get_num_pack_id_from_metadata(metadata)
+    if num_pack_id is None:
+        # metadata doesn't always carry the number id, scrape it from share page then
+        num_pack_id, _ = get_num_pack_id_and_title(id_url)
+    pack_info = {
+        'title_kr': metadata['title'],
+        'title': text_id,
+        'text_id': text_id,
+        'pack_id': num_pack_id,
+        'share_link_id': share_link_id,
+        'count': len(metadata['thumbnailUrls']),
+        'archive_md5': None
+    }
+    with open(cache_path, 'w', encoding='utf-8') as f:
+        json.dump({'etag': etag, 'pack_info': pack_info}, f, ensure_ascii=False, indent=4)
+    return pack_info
+
+
+def update_cached_pack_id(cache_dir, share_link_id, pack_id):
+    # keep the cache in line with the id the archive was actually found under
+    cache_path = os.path.join(cache_dir, f'{share_link_id}.json')
+    if not os.path.exists(cache_path):
+        return
+    with open(cache_path, 'r', encoding='utf-8') as f:
+        cached = json.load(f)
+    cached['pack_info']['pack_id'] = pack_id
+    with open(cache_path, 'w', encoding='utf-8') as f:
+        json.dump(cached, f, ensure_ascii=False, indent=4)
+
+
+def find_local_pack_info(sticker_data_root_dir, share_link_id):
+    with os.scandir(sticker_data_root_dir) as it:
+        for entry in it:
+            if not entry.is_dir():
+                continue
+            # open metadata file to see if share_link_id match
+            try:
+                with open(os.path.join(entry.path, 'info.json'), 'r', encoding='utf-8') as f:
+                    pack_info = json.load(f)
+            except (FileNotFoundError, json.JSONDecodeError):
+                # in batch mode, another pack may be rewriting its info.json right now
+                continue
+            if pack_info['share_link_id'] == share_link_id:
+                return pack_info
+    return None
+
+
+def get_archive_size_and_etag(num_pack_id):
+    resp = _SESSION.head(ARCHIVE_URL_TEMPLATE.format(num_pack_id=num_pack_id), allow_redirects=True,
+                         timeout=_TIMEOUT, proxies=_proxies)
+    if not resp.ok:
+        # HEAD isn't supported everywhere, it's only needed for resuming
+        return 0, None
+    return int(resp.headers.get('Content-Length', 0)), resp.headers.get('ETag')
+
+
+def download_sticker_archive(num_pack_id, dest_path, resume_etag=None, on_etag=None):
+    # stream to disk and hash on the fly, so the archive is never held in memory
+    # with resume_etag, the partial file is continued if the archive is still the same one
+    # on_etag is called with the etag before the body is downloaded, to allow resuming if interrupted
+    offset = os.path.getsize(dest_path) if resume_etag and os.path.exists(dest_path) else 0
+    headers = {'Range': f'bytes={offset}-', 'If-Range': resume_etag} if offset else None
+    md5 = hashlib.md5()
+    with _SESSION.get(ARCHIVE_URL_TEMPLATE.format(num_pack_id=num_pack_id), headers=headers, stream=True,
+                      timeout=(5, 60), proxies=_proxies) as resp:
+        resp.raise_for_status()
+        etag = resp.headers.get('ETag', resume_etag)
+        if on_etag:
+            on_etag(etag)
+        if resp.status_code == 206:
+            _update_hash_from_file(md5, dest_path)
+            mode = 'ab'
+        else:
+            # archive changed or range isn't supported, start over
+            mode = 'wb'
+        with open(dest_path, mode) as f:
+            for chunk in resp.iter_content(64 * 1024):
+                md5.update(chunk)
+                f.write(chunk)
+        return md5.hexdigest(), etag
 
 
-def get_sticker_archive(num_pack_id):
-    archive_content = requests.get(f'https://item.kakaocdn.net/dw/{num_pack_id}.file_pack.zip', headers=_HEADER_KAKAO,
-                                   proxies=_proxies)
-    return archive_content.content
+def _update_hash_from_file(h, path, bufsize=1 << 20):
+    with open(path, 'rb', buffering=0) as f:
+        for block in iter(lambda: f.read(bufsize), b''):
+            h.update(block)
+    return h
 
 
-def main():
+def _md5_file(path, bufsize=1 << 20):
+    return _update_hash_from_file(hashlib.md5(), path, bufsize).hexdigest()
+
+
+def save_pack_info(sticker_pack_root, pack_info):
+    with open(os.path.join(sticker_pack_root, 'info.json'), 'w', encoding='utf-8') as f:
+        json.dump(pack_info, f, ensure_ascii=False, indent=4)
+
+
+def make_arg_parser(batch=False):
     arg_parser = argparse.ArgumentParser(description='Download stickers from Kakao store')
-    arg_parser.add_argument('id_url', type=str, help='ID or share like of sticker set')
+    if not batch:
+        arg_parser.add_argument('id_url', type=str, help='ID or share like of sticker set')
 
     arg_parser.add_argument('--proxy', type=str, help='HTTPS proxy, addr:port')
     arg_parser.add_argument('-y', action='store_true', help='Skip confirmation')
     arg_parser.add_argument('--redownload', action='store_true', help='Redownload stickers even if they exist')
+    arg_parser.add_argument('--refresh-metadata', action='store_true',
+                            help='Fetch pack metadata again instead of using local cache')
     arg_parser.add_argument('--no-subdir', action='store_true',
                             help='Do not create subdirectory for different output formats')
 
@@ -83,26 +220,32 @@ def main():
     # works for gif, png and webm. For mp4 video, alpha is always removed
     arg_parser.add_argument('--remove-alpha', help='Replace transparent background with white', action='store_true')
 
-    arg_parser.add_argument('-t', '--threads', type=int, help='Thread number of processor, default 8', default=8)
+    arg_parser.add_argument('-t', '--threads', type=int,
+                            help='Thread number of processor, default CPU count shared by packs processed at once')
 
-    args = arg_parser.parse_args()
+    if batch:
+        arg_parser.add_argument('--batch-workers', type=int, help='Number of packs downloaded at once, default 4',
+                                default=4)
+        arg_parser.add_argument('--processes', action='store_true',
+                                help='Download each pack in a separate process instead of a thread')
+    return arg_parser
 
-    sticker_data_root_dir = os.path.join(os.getcwd(), 'sticker_dl')
-    if not os.path.exists(sticker_data_root_dir):
-        os.mkdir(sticker_data_root_dir)
 
-    default_sticker_output_root_dir = os.path.join(os.getcwd(), 'sticker_out')
-    if not os.path.exists(default_sticker_output_root_dir):
-        os.mkdir(default_sticker_output_root_dir)
+def download_pack(id_url, args, concurrent_packs=1):
+    # concurrent_packs: number of packs processed at the same time, they share the cores
+    # several packs may be downloaded concurrently in batch mode, so directories may be created by another thread
+    sticker_data_root_dir = os.path.join(os.getcwd(), 'sticker_dl')
+    os.makedirs(sticker_data_root_dir, exist_ok=True)
 
     proxies = {}
     if args.proxy:
         proxies['https'] = args.proxy
         set_proxy(proxies)
 
-    num_process_threads = args.threads
+    cpu_share = max(1, (os.cpu_count() or 1) // concurrent_packs)
+    num_process_threads = args.threads or cpu_share
 
-    id_url = args.id_url.strip()
+    id_url = id_url.strip()
     output_fmt = args.output_fmt
     skip_confirmation = args.y
     no_sub_dir = args.no_subdir
@@ -113,12 +256,12 @@ def main():
         default_sticker_output_root_dir = os.path.join(os.getcwd(), 'sticker_out')
     else:
         default_sticker_output_root_dir = args.output_dir
-    global norm_print
+    # keep the printer local, batch mode runs several packs in parallel in the same process
+    norm_print = print
     if quiet:
         norm_print = lambda *args, **kwargs: None
         skip_confirmation = True
-    if not os.path.exists(default_sticker_output_root_dir):
-        os.mkdir(default_sticker_output_root_dir)
+    os.makedirs(default_sticker_output_root_dir, exist_ok=True)
 
     if 'http' not in id_url:
         num_pack_id = id_url
@@ -130,35 +273,29 @@ def main():
         share_link_id = id_url.split('/')[-1].split('?')[0]
 
     # from here, pack_id should be ready. Check if the sticker set has already been downloaded
-    for d in os.listdir(sticker_data_root_dir):
-        if os.path.isdir(os.path.join(sticker_data_root_dir, d)):
-            # open metadata file to see if share_link_id match
-            if os.path.exists(os.path.join(sticker_data_root_dir, d, 'info.json')):
-                with open(os.path.join(sticker_data_root_dir, d, 'info.json'), 'r', encoding='utf-8') as f:
-                    pack_info = json.load(f)
-                    if pack_info['share_link_id'] == share_link_id:
-                        norm_print(f"Found local metadata for pack named {pack_info['title']}!")
-                        break
+    local_pack_info = find_local_pack_info(sticker_data_root_dir, share_link_id)
+    meta_cache_dir = os.path.join(sticker_data_root_dir, '.meta_cache')
+    if local_pack_info and not args.refresh_metadata:
+        pack_info = local_pack_info
+        norm_print(f"Found local metadata for pack named {pack_info['title']}!")
     else:
-        # not found. download
-        num_pack_id, title = get_num_pack_id_and_title(id_url)
-        text_id = get_sticker_text_id(id_url)
-        metadata = get_metadata(text_id)
-        pack_info = {
-            'title_kr': metadata['title'],
-            'title': text_id,
-            'text_id': text_id,
-            'pack_id': num_pack_id,
-            'share_link_id': share_link_id,
-            'count': len(metadata['thumbnailUrls']),
-            'archive_md5': None
-        }
+        # not found or refresh requested. use cache or download
+        os.makedirs(meta_cache_dir, exist_ok=True)
+        pack_info = fetch_pack_info(id_url, share_link_id, meta_cache_dir, refresh=args.refresh_metadata)
+        if local_pack_info:
+            # the local id has been proven against the archive, metadata may carry another one
+            if pack_info['pack_id'] != local_pack_info['pack_id']:
+                pack_info['pack_id'] = local_pack_info['pack_id']
+                update_cached_pack_id(meta_cache_dir, share_link_id, pack_info['pack_id'])
+            pack_info['archive_md5'] = local_pack_info['archive_md5']
+            pack_info['archive_etag'] = local_pack_info.get('archive_etag')
     sticker_count = pack_info['count']
     num_pack_id = pack_info['pack_id']
     title = pack_info['title']
     text_id = pack_info['text_id']
     scale_px = 0
     if output_fmt == 'webm':
+        # webm frames are scaled to 512px by the ffmpeg encode itself
         scale_px = 512
 
     norm_print('-----------------Sticker pack info:-----------------')
@@ -195,62 +332,70 @@ def main():
     if not os.path.isdir(sticker_dl_path):
         os.mkdir(sticker_dl_path)
 
-    sticker_process_temp_root = tempfile.mkdtemp()
-    sticker_temp_store_extracted_zip_path = os.path.join(sticker_process_temp_root, 'extracted')
-
     # check if the archive has already been downloaded
     archive_path = os.path.join(sticker_dl_path, 'archive.zip')
     download_archive = True
+    resume_etag = None
     if os.path.exists(archive_path):
         # verify integrity using md5
         norm_print('Archive exists. Verifying integrity... ', end='')
-        with open(archive_path, 'rb') as f:
-            archive_content = f.read()
-        archive_md5 = hashlib.md5(archive_content).hexdigest()
-        if archive_md5 == pack_info['archive_md5']:
+        if _md5_file(archive_path) == pack_info['archive_md5']:
             norm_print('OK!')
             download_archive = False
         else:
-            norm_print('Verification failed! Redownload...')
-            os.remove(archive_path)
+            # an unfinished download of the same archive can be continued
+            remote_size, etag = get_archive_size_and_etag(num_pack_id)
+            if etag and etag == pack_info.get('archive_etag') and os.path.getsize(archive_path) < remote_size:
+                norm_print('Verification failed! Resume download...')
+                resume_etag = etag
+            else:
+                norm_print('Verification failed! Redownload...')
+                os.remove(archive_path)
     if download_archive:
+        def save_etag(etag):
+            # save etag before downloading, so the download can be resumed if interrupted
+            pack_info['archive_etag'] = etag
+            pack_info['archive_md5'] = None
+            save_pack_info(sticker_pack_root, pack_info)
+
         # download sticker pack
         norm_print('Downloading sticker pack archive... ', end='')
-        archive_content = get_sticker_archive(num_pack_id)
+        # md5 is kept for future verification
+        try:
+            archive_md5, archive_etag = download_sticker_archive(num_pack_id, archive_path, resume_etag, save_etag)
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code != 404:
+                raise
+            # number id taken from metadata may not be the archive id, scrape it from share page then
+            scraped_pack_id, _ = get_num_pack_id_and_title(id_url)
+            if scraped_pack_id == num_pack_id:
+                raise
+            num_pack_id = pack_info['pack_id'] = scraped_pack_id
+            update_cached_pack_id(meta_cache_dir, share_link_id, num_pack_id)
+            archive_md5, archive_etag = download_sticker_archive(num_pack_id, archive_path, None, save_etag)
+        pack_info['archive_md5'], pack_info['archive_etag'] = archive_md5, archive_etag
         norm_print('Complete!')
-        # save archive and unzip to temp folder
-        with open(archive_path, 'wb') as f:
-            f.write(archive_content)
-        # calculate md5 for future verification
-        archive_md5 = hashlib.md5(archive_content).hexdigest()
-        pack_info['archive_md5'] = archive_md5
 
-    with open(os.path.join(sticker_pack_root, 'info.json'), 'w', encoding='utf-8') as f:
-        json.dump(pack_info, f, ensure_ascii=False, indent=4)
+    save_pack_info(sticker_pack_root, pack_info)
 
     sticker_raw_path = os.path.join(sticker_pack_root, 'raw')
 
     if not os.path.isdir(sticker_raw_path):
         os.mkdir(sticker_raw_path)
         norm_print('Extracting archive... ', end='')
+        # decrypt straight from the archive into raw folder
         with zipfile.ZipFile(archive_path, 'r') as zip_ref:
-            zip_ref.extractall(sticker_temp_store_extracted_zip_path)
-        for fn in os.listdir(sticker_temp_store_extracted_zip_path):
-            name, ext = os.path.splitext(fn)
-            if ext in [".gif", ".webp"]:
-                with open(os.path.join(sticker_temp_store_extracted_zip_path, fn), 'rb') as f:
-                    decrypted = data_xor(f.read())
-                with open(os.path.join(sticker_temp_store_extracted_zip_path, fn), 'wb') as f:
-                    f.write(decrypted)
+            for info in zip_ref.infolist():
+                if info.is_dir():
+                    continue
+                fn = os.path.basename(info.filename)
+                name, ext = os.path.splitext(fn)
+                with zip_ref.open(info) as src, open(os.path.join(sticker_raw_path, fn), 'wb') as out:
+                    if ext.lower() in ['.gif', '.webp']:
+                        data_xor_stream(src, out)
+                    else:
+                        shutil.copyfileobj(src, out, 1 << 16)
         norm_print('Complete!')
-
-        # copy useful files to raw folder and rename
-
-        for fn in os.listdir(sticker_temp_store_extracted_zip_path):
-            shutil.copy(os.path.join(sticker_temp_store_extracted_zip_path, fn),
-                        os.path.join(sticker_raw_path, fn))
-        # cleanup temp folder
-        shutil.rmtree(sticker_temp_store_extracted_zip_path)
     else:
         norm_print('Sticker pack already exists, skip unarchive...')
 
@@ -258,7 +403,7 @@ def main():
         norm_print('No processing will be done, exit...')
         if open_folder:
             os.startfile(sticker_pack_root)
-        sys.exit(0)
+        return
 
     # check dependency for processing
     if not shutil.which('magick'):
@@ -275,8 +420,7 @@ def main():
         err_print(f'FAILED: Invalid output format {output_fmt}!')
         sys.exit(1)
 
-    process_queue = Queue()
-
+    tasks = []
     if no_sub_dir:
         sticker_output_path = os.path.join(default_sticker_output_root_dir, sanitized_title)
     else:
@@ -284,8 +428,7 @@ def main():
                                            output_format.value)
     if scale_px:
         sticker_output_path += f'_scale_{scale_px}'
-    if not os.path.isdir(sticker_output_path):
-        os.makedirs(sticker_output_path)
+    os.makedirs(sticker_output_path, exist_ok=True)
 
     for i in range(sticker_count):
         # zero padding to 3 digits
@@ -294,8 +437,6 @@ def main():
         in_pic = os.path.join(sticker_raw_path, sticker_fn)
         result_output = os.path.join(sticker_output_path, f'{num_pack_id}-{i + 1:03d}.{output_format.value}')
         operations = []
-        if scale_px:
-            operations.append(Operation.SCALE)
         if if_remove_alpha:
             operations.append(Operation.REMOVE_ALPHA)
         if output_format == OutputFormat.GIF:
@@ -304,39 +445,35 @@ def main():
             operations.append(Operation.TO_WEBM)
 
         task = ProcessTask(sticker_id, in_pic, None, scale_px, operations, result_output)
-        process_queue.put_nowait(task)
-
-    processor = [KakaoProcessor(process_queue, sticker_process_temp_root, output_format) for _ in
-                 range(num_process_threads)]
-
-    for p in processor:
-        p.start()
-
-    if not quiet:
-        with tqdm(total=sticker_count) as bar:
-            last = 0
-            while not process_queue.empty():
-                completed = get_counter_value()
-                bar.update(completed - last)
-                bar.refresh()
-                last = completed
-                time.sleep(0.5)
-            process_queue.join()
-            bar.n = sticker_count
-            bar.refresh()
-            bar.clear()
-    else:
-        process_queue.join()
+        tasks.append(task)
+
+    # no more workers than stickers, and share the cores between them
+    # instead of letting every child process use all of them
+    num_process_threads = max(1, min(num_process_threads, len(tasks)))
+    thread_limit = max(1, cpu_share // num_process_threads)
+    # temp dir is removed whether processing finishes, fails or is interrupted
+    with tempfile.TemporaryDirectory(prefix='kakao_') as sticker_process_temp_root, \
+            ThreadPoolExecutor(num_process_threads) as executor:
+        futures = [executor.submit(process_task, task, sticker_process_temp_root, output_format, thread_limit)
+                   for task in tasks]
+        try:
+            for future in tqdm(as_completed(futures), total=sticker_count, disable=quiet, leave=False):
+                future.result()
+        except KeyboardInterrupt:
+            # don't start the remaining stickers, only wait for the running ones before cleanup
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
 
     norm_print('Process done!')
 
-    # remove temp dir
-    shutil.rmtree(sticker_process_temp_root)
-    # debug
-    # os.startfile(sticker_process_temp_root)
     if open_folder:
         os.startfile(sticker_output_path)
 
 
+def main():
+    args = make_arg_parser().parse_args()
+    download_pack(args.id_url, args)
+
+
 if __name__ == '__main__':
     main()
@@ -1,11 +1,9 @@
-import datetime
 import os
 import shutil
 import subprocess
 import traceback
 from enum import Enum
-from queue import Empty, Queue
-from threading import Lock, Thread
+from threading import Lock
 
 import ffmpeg
 
@@ -14,25 +12,20 @@ _print_lock = Lock()
 GIF_ALPHA_THRESHOLD = 1
 WEBM_SIZE_KB_MAX = 256
 WEBM_DURATION_SEC_MAX = 3
-_counter_lock = Lock()
-_task_completed_counter = 0
+# frame pngs are only read once by ffmpeg, fast compression is worth more than size
+_FRAME_PNG_OPTIONS = ['-define', 'png:compression-level=1']
 
 
-def get_counter_value():
-    with _counter_lock:
-        return _task_completed_counter
+def _is_animated_webp(path):
+    # animation flag lives in the VP8X header, simple (VP8/VP8L) webp files are always still
+    with open(path, 'rb') as f:
+        header = f.read(21)
+    return header[12:16] == b'VP8X' and bool(header[20] & 0x02)
 
 
-def increment_counter():
-    with _counter_lock:
-        global _task_completed_counter
-        _task_completed_counter += 1
-
-
-def reset_counter():
-    with _counter_lock:
-        global _task_completed_counter
-        _task_completed_counter = 0
+def _escape_concat_path(path):
+    # inside single quotes of a concat script, only the quote itself needs escaping
+    return os.path.abspath(path).replace("'", "'\\''")
 
 
 class OutputFormat(Enum):
@@ -44,12 +37,25 @@ class OutputFormat(Enum):
 
 
 class Operation(Enum):
-    SCALE = 'scale'
     REMOVE_ALPHA = 'remove_alpha'
     TO_GIF = 'to_gif'
     TO_WEBM = 'to_webm'
 
 
+_MAGICK_OPERATIONS = (Operation.REMOVE_ALPHA, Operation.TO_GIF)
+
+
+def _plan_segments(operations):
+    # group adjacent imagemagick operations, each group runs as a single command
+    segments = []
+    for op in operations:
+        if segments and op in _MAGICK_OPERATIONS and segments[-1][-1] in _MAGICK_OPERATIONS:
+            segments[-1].append(op)
+        else:
+            segments.append([op])
+    return segments
+
+
 class ProcessTask:
     def __init__(self, sticker_id, in_img_path, in_audio_path, scale_px, operations,
                  result_output_path):
@@ -61,63 +67,65 @@ class ProcessTask:
         self.result_path = result_output_path
 
 
-class KakaoProcessor(Thread):
-    def __init__(self, queue, temp_dir, output_format):
-        Thread.__init__(self)
-        self.queue: Queue = queue
+def process_task(task, temp_dir, output_format, thread_limit=None):
+    KakaoProcessor(temp_dir, output_format, thread_limit).process(task)
+
+
+class KakaoProcessor:
+    def __init__(self, temp_dir, output_format, thread_limit=None):
         self.temp_dir = temp_dir
         self.output_format = output_format
+        # several processors run at once, keep imagemagick and ffmpeg from each using every core
+        self.thread_limit = thread_limit or os.cpu_count() or 1
+        self._magick_env = {**os.environ, 'MAGICK_THREAD_LIMIT': str(self.thread_limit), 'MAGICK_THROTTLE': '0'}
         self._current_sticker_id = None
 
-    def run(self) -> None:
-
-        while not self.queue.empty():
-            try:
-                task: ProcessTask = self.queue.get_nowait()
-            except Empty:
-                continue
-            self._current_sticker_id = task.sticker_id
-            try:
-                # frames need to be split first before processing
-                frame_temp_dir = self.make_frame_temp_dir()
-
-                curr_in = task.in_img
-                for i, op in enumerate(task.operations):
-                    curr_out = os.path.join(self.temp_dir, f'{self._current_sticker_id}_interim_{i}.tmp')
-                    if op == Operation.SCALE:
-                        self.scale(curr_in, curr_out, task.scale_px)
-                    elif op == Operation.REMOVE_ALPHA:
-                        self.remove_alpha(curr_in, curr_out)
-                    elif op == Operation.TO_GIF:
-                        self.to_gif(curr_in, curr_out)
-                    elif op == Operation.TO_WEBM:
-                        frame_dir = self.make_frame_temp_dir()
-                        durations = self.split_webp_frames(curr_in, frame_dir)
-                        webm_uncapped = os.path.join(self.temp_dir, f'{self._current_sticker_id}.raw.webm')
-                        self.to_webm(durations, frame_temp_dir, webm_uncapped)
-                        self.cap_webm_duration_and_size(durations, webm_uncapped, frame_temp_dir, curr_out)
-                    curr_in = curr_out
-                shutil.copy(curr_in, task.result_path)
-
-            except ffmpeg.Error as e:
-                with _print_lock:
-                    print('Error occurred while processing', e, task.sticker_id)
-                    print('------stdout------')
-                    print(e.stdout.decode())
-                    print('------end------')
-                    print('------stderr------')
-                    print(e.stderr.decode())
-                    print('------end------')
-                    traceback.print_exc()
-                return
-            except Exception as e:
-                with _print_lock:
-                    print('Error occurred while processing', e, task.sticker_id)
-                    traceback.print_exc()
-                return
-            finally:
-                self.queue.task_done()
-                increment_counter()
+    def process(self, task: ProcessTask) -> None:
+        self._current_sticker_id = task.sticker_id
+        try:
+            # frames need to be split first before processing
+            frame_temp_dir = self.make_frame_temp_dir()
+
+            curr_in = task.in_img
+            for i, segment in enumerate(_plan_segments(task.operations)):
+                curr_out = os.path.join(self.temp_dir, f'{self._current_sticker_id}_interim_{i}.tmp')
+                if segment[0] in _MAGICK_OPERATIONS:
+                    # adjacent imagemagick operations are done in one command, without interim files
+                    options = []
+                    for op in segment:
+                        if op == Operation.REMOVE_ALPHA:
+                            options += self.remove_alpha_options()
+                        elif op == Operation.TO_GIF:
+                            options += self.to_gif_options()
+                    out_format = 'GIF' if Operation.TO_GIF in segment else 'WEBP'
+                    self._run_magick(['WEBP:' + curr_in] + options + [f'{out_format}:{curr_out}'])
+                elif segment[0] == Operation.TO_WEBM:
+                    frame_dir = self.make_frame_temp_dir()
+                    durations = self.split_webp_frames(curr_in, frame_dir)
+                    self.cap_webm_duration_and_size(durations, frame_temp_dir, curr_out)
+                curr_in = curr_out
+            shutil.copy(curr_in, task.result_path)
+
+        except ffmpeg.Error as e:
+            with _print_lock:
+                print('Error occurred while processing', e, task.sticker_id)
+                print('------stdout------')
+                print(e.stdout.decode())
+                print('------end------')
+                print('------stderr------')
+                print(e.stderr.decode())
+                print('------end------')
+                traceback.print_exc()
+        except subprocess.CalledProcessError as e:
+            with _print_lock:
+                print('Error occurred while processing', e, task.sticker_id)
+                print('------stderr------')
+                print(e.stderr.decode(errors='ignore'))
+                print('------end------')
+        except Exception as e:
+            with _print_lock:
+                print('Error occurred while processing', e, task.sticker_id)
+                traceback.print_exc()
 
     def make_frame_temp_dir(self):
         frame_working_dir_path = os.path.join(self.temp_dir, 'frames_' + self._current_sticker_id)
@@ -125,18 +133,9 @@ class KakaoProcessor(Thread):
             os.mkdir(frame_working_dir_path)
         return frame_working_dir_path
 
-    def _make_frame_file(self, durations, frame_working_dir_path):
-        with open(os.path.join(frame_working_dir_path, 'frames.txt'), 'w') as f:
-            for i, d in enumerate(durations):
-                f.write(f"file 'frame-{i:02d}.png'\n")
-                f.write(f'duration {d}\n')
-            # last frame need to be put twice, see: https://trac.ffmpeg.org/wiki/Slideshow
-            # f.write(f"file 'frame-{len(durations) - 1}.png'\n")
-        return os.path.join(frame_working_dir_path, 'frames.txt')
-
-    def scale(self, in_file, out_file, scale_px):
-        subprocess.call(
-                ['magick', 'convert', 'WEBP:' + in_file, '-resize', f'{scale_px}x{scale_px}', 'WEBP:' + out_file])
+    def _run_magick(self, args):
+        subprocess.run([_MAGICK_BIN] + args, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                       env=self._magick_env)
 
     # def scale_frames(self, scale_px, frame_dir):
     #     frame_scale_temp_dir = os.path.join(frame_dir, 'scale')
@@ -155,10 +154,8 @@ class KakaoProcessor(Thread):
     #         shutil.move(os.path.join(frame_scale_temp_dir, frame_file), os.path.join(frame_dir, frame_file))
     #     os.rmdir(frame_scale_temp_dir)
 
-    def remove_alpha(self, in_file, out_file):
-        subprocess.call(['magick', 'convert', 'WEBP:' + in_file, '-background',
-                         'white', '-alpha', 'remove', '-alpha', 'off',
-                         'WEBP:' + out_file])
+    def remove_alpha_options(self):
+        return ['-background', 'white', '-alpha', 'remove', '-alpha', 'off']
 
     # def remove_alpha_frames(self, frame_dir):
     #     frame_scale_temp_dir = os.path.join(frame_dir, 'alpharm')
@@ -174,33 +171,36 @@ class KakaoProcessor(Thread):
     #         shutil.move(os.path.join(frame_scale_temp_dir, frame_file), os.path.join(frame_dir, frame_file))
     #     os.rmdir(frame_scale_temp_dir)
 
-    def to_gif(self, in_file, out_file):
+    def to_gif_options(self):
         # use imagemagick to convert webp to gif
-        subprocess.call(
-                ['magick', 'convert', 'WEBP:' + in_file, '-channel', 'A', '-threshold', '99%', 'GIF:' + out_file])
-        subprocess.call(['magick', 'GIF:' + out_file, '-coalesce', 'GIF:' + out_file])
+        return ['-coalesce', '-channel', 'A', '-threshold', '99%']
 
     def split_webp_frames(self, in_file, frame_dir):
         # split frames using imagemagick, and reconstruct frames based on disposal/blending
         if not os.path.isdir(frame_dir):
             os.mkdir(frame_dir)
-        subprocess.call(
-                [_MAGICK_BIN, 'WEBP:' + in_file, '-coalesce', os.path.join(frame_dir, 'frame-%02d.png')])
-
+        if not _is_animated_webp(in_file):
+            # still image, nothing to coalesce. identify reports no delay for it
+            self._run_magick(['WEBP:' + in_file] + _FRAME_PNG_OPTIONS + [os.path.join(frame_dir, 'frame-00.png')])
+            return [0.0]
+        # coalesce and identify don't depend on each other, run them side by side
+        coalesce = subprocess.Popen(
+                [_MAGICK_BIN, 'WEBP:' + in_file, '-coalesce'] + _FRAME_PNG_OPTIONS +
+                [os.path.join(frame_dir, 'frame-%02d.png')],
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=self._magick_env)
+
+        # only frame delays are needed, geometry and blend/dispose are already applied by coalesce
         p = subprocess.Popen(
-                [_MAGICK_BIN, 'identify', '-format', r'%T,%W,%H,%w,%h,%X,%Y,%[webp:mux-blend],%D|', in_file],
+                [_MAGICK_BIN, 'identify', '-format', r'%T|', in_file],
                 stdin=None, stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE, shell=False)
+                stderr=subprocess.PIPE, shell=False, env=self._magick_env)
         out, err = p.communicate()
+        _, coalesce_err = coalesce.communicate()
+        for proc, proc_err in [(coalesce, coalesce_err), (p, err)]:
+            if proc.returncode != 0:
+                raise subprocess.CalledProcessError(proc.returncode, proc.args, stderr=proc_err)
         frame_data_str_output = out.decode().strip()[:-1]
-        image_w, image_h = 0, 0
-        frame_data = list()
-        for fd in frame_data_str_output.split('|'):
-            duration, cw, ch, w, h, x, y, blend_method, dispose_method = fd.split(',')
-            duration = round(int(duration) / 100.0, 2)
-            cw, ch, w, h, x, y = [int(i) for i in [cw, ch, w, h, x, y]]
-            image_w, image_h = cw, ch
-            frame_data.append((duration, (w, h, x, y), blend_method, dispose_method))
+        durations = [round(int(delay) / 100.0, 2) for delay in frame_data_str_output.split('|')]
 
         # # added for debugging purposes
         # try:
@@ -211,7 +211,6 @@ class KakaoProcessor(Thread):
         #     if i.startswith('frame-') and i.endswith('.png'):
         #         shutil.copy(os.path.join(frame_dir, i), os.path.join(frame_dir, 'raw'))
 
-        durations = [f[0] for f in frame_data]
         return durations
 
     def to_webm(self, durations, frame_dir, out_file):
@@ -224,43 +223,60 @@ class KakaoProcessor(Thread):
         # so shouldn't set it too small - which will cause too much error
         # https://bugs.telegram.org/c/14778
 
-        frame_file_path = self._make_frame_file(durations, frame_dir)
-        ffmpeg.input(frame_file_path, format='concat') \
-            .filter('scale', w='if(gt(iw,ih),512,-1)', h='if(gt(iw,ih),-1,512)') \
-            .output(out_file, r=30, fps_mode='cfr', f='webm') \
+        # concat script is fed through stdin, paths have to be absolute then
+        concat_script = ''.join(
+                f"file '{_escape_concat_path(os.path.join(frame_dir, f'frame-{i:02d}.png'))}'\nduration {d}\n"
+                for i, d in enumerate(durations))
+        stream = ffmpeg.input('pipe:', format='concat', safe=0, protocol_whitelist='pipe,file') \
+            .filter('scale', w='if(gt(iw,ih),512,-1)', h='if(gt(iw,ih),-1,512)')
+        # vp9 encoding is the slowest step, row-mt lets libvpx use the threads it's given
+        stream.output(out_file, r=30, fps_mode='cfr', f='webm', threads=self.thread_limit,
+                      **{'c:v': 'libvpx-vp9', 'row-mt': 1, 'tile-columns': 2, 'deadline': 'good', 'cpu-used': 4}) \
             .overwrite_output() \
-            .run(quiet=True)
+            .run(input=concat_script.encode(), quiet=True)
 
     def probe_duration(self, file):
-        duration_str = ffmpeg.probe(file)['streams'][0]['tags']['DURATION']
-
-        hms, us = duration_str.split('.')
-        us = us[:6]
-        duration_str = f'{hms}.{us}'
-        duration_dt = datetime.datetime.strptime(duration_str, '%H:%M:%S.%f')
-        duration_seconds = datetime.timedelta(seconds=duration_dt.second,
-                                              microseconds=duration_dt.microsecond).total_seconds()
+        # ask ffprobe for the bare number, no json or timestamp parsing needed
+        out = subprocess.run(['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of', 'csv=p=0', file],
+                             check=True, capture_output=True).stdout
+        return float(out.decode().strip())
+
+    def estimate_duration(self, durations):
+        # output is 30fps cfr, so its duration is the sum of frame durations rounded to whole frames
+        return round(sum(durations) * 30) / 30
+
+    def measure_duration(self, durations, file):
+        duration_seconds = self.estimate_duration(durations)
+        if abs(duration_seconds - WEBM_DURATION_SEC_MAX) < 1 / 60:
+            # rounding may go either way this close to the limit, ask ffprobe
+            duration_seconds = self.probe_duration(file)
         return duration_seconds
 
-    def cap_webm_duration_and_size(self, durations, in_webm, frame_dir, out_file):
+    def cap_webm_duration_and_size(self, durations, frame_dir, out_file):
         # TODO even after optimization, webm file size may still exceed the limit. Lossy compression may be needed
 
-        # probe duration, ensure it's max 3 seconds
-        duration_seconds = self.probe_duration(in_webm)
+        # ensure duration is max 3 seconds
+        # stickers clearly over the limit skip the uncapped encode, it would be thrown away
+        duration_seconds = self.estimate_duration(durations)
+        capping_passes = 2
+        if duration_seconds - WEBM_DURATION_SEC_MAX < 1 / 60:
+            self.to_webm(durations, frame_dir, out_file)
+            duration_seconds = self.measure_duration(durations, out_file)
+            capping_passes = 1
 
         if duration_seconds > WEBM_DURATION_SEC_MAX:
-            factor = duration_seconds / WEBM_DURATION_SEC_MAX
-            while True:
-                # loop to reduce frame duration until it's less than WEBM_DURATION_SEC_MAX seconds
-                new_durations = [int(d / factor * 1000) / 1000 for d in durations]
+            # leave one frame of headroom for cfr rounding, so one pass is usually enough
+            factor = duration_seconds / (WEBM_DURATION_SEC_MAX - 1 / 30)
+            for _ in range(capping_passes):
+                # no per-frame floor, cfr output merges frames shorter than 1/30s by itself
+                new_durations = [round(d / factor * 1000) / 1000 for d in durations]
                 self.to_webm(new_durations, frame_dir, out_file)
-                new_duration_seconds = self.probe_duration(file=out_file)
-                if new_duration_seconds > 3:
-                    factor = factor * 1.05
-                else:
+                new_duration_seconds = self.measure_duration(new_durations, out_file)
+                if new_duration_seconds <= WEBM_DURATION_SEC_MAX:
                     break
-        else:  # just copy
-            shutil.copyfile(in_webm, out_file)
+                factor *= new_duration_seconds / WEBM_DURATION_SEC_MAX
+            else:
+                raise RuntimeError(f'Failed to cap duration, still {new_duration_seconds} seconds')
 
         # see if file size is OK
         if os.path.getsize(out_file) > WEBM_SIZE_KB_MAX * 1024: